@@ -21,5 +21,6 @@ class MyT5Model(T5ForConditionalGeneration):
         # 这里可以修改或添加额外的训练步骤
         super().train(mode)
 
-# 创建自定义的T5模型实例
-model = MyT5Model.from_pretrained('t5-base')
+if __name__ == '__main__':
+    # 创建自定义的T5模型实例（只在直接运行时下载并构建，import時不加載模型）
+    model = MyT5Model.from_pretrained('t5-base')
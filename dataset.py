@@ -0,0 +1,155 @@
+import logging
+from pathlib import Path
+from typing import *
+
+from torch.utils.data import DataLoader, Dataset
+
+# train.py configures the root logger
+log = logging.getLogger()
+
+
+# A dataset for our inputs.
+class T5DataSet(Dataset):
+    def __init__(self, tokenizer, data_dir: str, type_path, max_examples=-1,
+                 max_src_len=2000, max_tgt_len=500):
+        """
+        max_examples: if > 0 then will load only max_examples into the dataset; -1 means use all
+
+        max_src and max_tgt len refer to number of tokens in the input sequences
+        # Note: these are not randomized. If they were we might need to collate.
+        """
+
+        valid_type_paths = ["test", "train", "val"]
+        assert type_path in valid_type_paths, f"Type path must be one of {valid_type_paths}"
+
+        self.example_path = Path(data_dir) / type_path
+        self.max_examples = max_examples
+        self.tokenizer = tokenizer
+
+        self.max_src_len = max_src_len  # max num of tokens in tokenize()
+        self.max_tgt_len = max_tgt_len
+
+        self.inputs = []            # list of dict
+        self.targets = []           # list of dict
+        self.input_text = []        # list of str
+        self.target_text = []       # list of str
+
+        self._build()       # fill inputs, targets, max_lens
+
+    def __len__(self):
+        return len(self.inputs)
+
+    # __getitem__方法用於根據索引從數據集中獲取一個樣本。
+    def __getitem__(self, index):
+        source_ids = self.inputs[index]["input_ids"].squeeze()
+        target_ids = self.targets[index]["input_ids"].squeeze()
+
+        src_mask    = self.inputs[index]["attention_mask"].squeeze()  # might need to squeeze
+        target_mask = self.targets[index]["attention_mask"].squeeze()  # might need to squeeze
+
+        src_text = self.input_text[index]
+        tgt_text = self.target_text[index]
+
+        # These will be cast to torch.long in forward
+        # index identifies the example (e.g. for the encoder cache)
+        return {"source_ids": source_ids, "source_mask": src_mask,
+                "target_ids": target_ids, "target_mask": target_mask,
+                "source_text": src_text, "target_text": tgt_text,
+                "index": index}
+
+    # _build方法用於構建數據集，從源文本文件和目標文本文件中讀取文本數據。
+    def _build(self):
+        source_path = self.example_path.with_suffix(".source")
+        target_path = self.example_path.with_suffix(".target")
+
+        with open(source_path, 'r') as f_source, \
+                open(target_path, 'r') as f_target:
+
+            source, target = f_source.readlines(), f_target.readlines()
+            source_ct, target_ct = len(source), len(target)
+
+            # for i in range(min(source_ct, target_ct)):
+            #     print("Source Line", i + 1, ":", source[i])
+            #     print("Target Line", i + 1, ":", target[i])
+
+
+            assert source_ct == target_ct, f"Lengths don't match"
+            # Note we could batch encode
+            log.warning(f'Using max_src_len, max_tgt_len = ({self.max_src_len}, {self.max_tgt_len})')
+
+            inputs_out = []     # accumulate the output of batch_encode
+            targets_out = []    # same
+            inputs_text = []    # save the original text for evaluations
+            targets_text = []   # same
+
+            if self.max_examples > 0 :
+                source_ct = min(self.max_examples, source_ct)
+
+            for idx in range(source_ct):
+                # append end of sequence tokens (not necessary) because handled by tokenize() call
+
+                src = source[idx].strip()
+                tgt = target[idx].strip()
+                # 去除源文本和目標文本的首尾空格
+                # 將處理後的文本添加到inputs_text和targets_text列表中。
+                inputs_text.append(src)
+                targets_text.append(tgt)
+
+                # tokenize
+                # padding="max_length" pads to max_len
+                # 如果使用padding = "max_length"會將序列填充到最大長度
+                # otherwise (e.g. for batch), we could use padding=longest with truncation
+                # note: don't need add_special_tokens since EOS added automatically and others are PAD
+                # self.tokenizer returns a dict of input_ids and attention_masks (where attn masks corresponds to padding)
+                # self.tokenizer會返回一個字典，包含input_ids和attention_masks，
+                # 其中注意力遮罩（attention_masks）對應填充部分
+                # Note: padding could also be done via collate in dataloader
+                # todo: we could actually batch encode these (i.e. multiple per)
+                tokenized_inputs = self.tokenizer(
+                    [src], max_length=self.max_src_len, padding="max_length", return_tensors="pt", truncation=True
+                )
+
+                # src: 要進行處理的原始文本。
+                # max_length: 設定輸出的序列的最大長度。如果原始文本超過該長度，將進行截斷；如果不足該長度，將進行填充。
+                # padding: 填充方式的設定。在這裡，使用 "max_length"，
+                # 表示將序列填充到 max_length長度。
+                # return_tensors: 設定返回的張量類型。這裡使用 "pt"
+                # 表示返回PyTorch張量。
+                # truncation: 是否進行截斷。在這裡，我們將文本截斷到max_length長度。
+                tokenized_targets = self.tokenizer(
+                    [tgt], max_length=self.max_tgt_len, padding="max_length", return_tensors="pt", truncation=True
+                )
+                inputs_out.append(tokenized_inputs)
+                targets_out.append(tokenized_targets)
+            self.inputs = inputs_out
+            self.targets = targets_out
+            self.input_text = inputs_text
+            self.target_text = targets_text
+
+
+def get_dataloaders(tokenizer, batch_size, num_train, num_val, data_dir, num_workers, max_src_len, max_tgt_len,
+                    shuffle_train=True, shuffle_dev=False, loader_kwargs=None,
+                    train_sampler_fn=None) -> Tuple[DataLoader, DataLoader]:
+    """
+    Returns: Tuple[train_loader : DataLoader, dev_loader : DataLoader]
+    # Note:
+    # - we default to not shuffling the dev set
+    # - loader_kwargs (see runtime.loader_kwargs) override num_workers and add pinning / persistent workers
+    # - train_sampler_fn(train_data_set) -> Sampler replaces shuffle_train (see sampling.py)
+
+    """
+    train_data_set = T5DataSet(tokenizer, type_path="train", data_dir=data_dir, max_examples=num_train,
+                               max_src_len=max_src_len, max_tgt_len=max_tgt_len)
+    eval_data_set = T5DataSet(tokenizer, type_path="val", data_dir=data_dir, max_examples=num_val,
+                              max_src_len=max_src_len, max_tgt_len=max_tgt_len)
+    if loader_kwargs is None:
+        loader_kwargs = {"num_workers": num_workers}
+    if train_sampler_fn is not None:
+        train_loader = DataLoader(train_data_set, batch_size=batch_size, sampler=train_sampler_fn(train_data_set),
+                                  **loader_kwargs)
+    else:
+        train_loader = DataLoader(train_data_set, batch_size=batch_size, shuffle=shuffle_train, **loader_kwargs)
+    eval_loader = DataLoader(eval_data_set, batch_size=batch_size, shuffle=shuffle_dev, **loader_kwargs)
+    log.info(f'Datasets loaded with sizes: train: {len(train_data_set)}, dev: {len(eval_data_set)}')
+
+    return train_loader, eval_loader
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+from typing import *
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+
+# 知識蒸餾：用一個大的教師模型(teacher)的輸出分佈作為軟目標，
+# 訓練一個小而快的學生模型(student)。
+# 教師的logits可以在訓練時即時計算，也可以預先計算好top-k並存到磁盤(memmap)以節省內存。
+
+
+def distillation_loss(student_logits: torch.Tensor, target_mask: torch.Tensor, teacher_values: torch.Tensor,
+                      teacher_indices: Optional[torch.Tensor] = None, temperature: float = 1.0,
+                      reduction: str = "mean") -> torch.Tensor:
+    """KL(teacher || student) per target token, averaged over the tokens that are not ignored.
+
+    Args:
+        student_logits (torch.Tensor): (batch_size, seq_len, vocab_size).
+        target_mask (torch.Tensor): (batch_size, seq_len) 1 for target tokens, 0 for padding.
+        teacher_values (torch.Tensor): (batch_size, seq_len, k) top-k teacher logits, or the full
+            (batch_size, seq_len, vocab_size) logits if `teacher_indices` is None.
+        teacher_indices (torch.Tensor): (batch_size, seq_len, k) vocab ids of `teacher_values`.
+        temperature (float): Softmax temperature; the loss is scaled by temperature ** 2.
+        reduction (str): "mean" over all target tokens, or "sum" to return the summed KL of every example
+            (e.g. to apply per-example importance weights before dividing by the token count).
+
+    Returns:
+        loss (torch.Tensor): Scalar, or (batch_size,) with reduction="sum".
+    """
+    student_logp = F.log_softmax(student_logits.float() / temperature, dim=-1)
+    if teacher_indices is not None:
+        # the teacher distribution is renormalized over its top-k tokens
+        student_logp = student_logp.gather(-1, teacher_indices.long())
+    teacher_logp = F.log_softmax(teacher_values.float() / temperature, dim=-1)
+
+    kl = (teacher_logp.exp() * (teacher_logp - student_logp)).sum(dim=-1)
+    mask = target_mask.to(kl.dtype)
+    if reduction == "sum":
+        return (kl * mask).sum(dim=1) * temperature ** 2
+    elif reduction == "mean":
+        return (kl * mask).sum() / mask.sum().clamp(min=1) * temperature ** 2
+    else:
+        raise ValueError(f"Invalid reduction {reduction}")
+
+
+def fingerprint(paths: List[str]) -> str:
+    """Hash of the names, sizes and modification times of `paths` (files or directories of files).
+
+    Used to tell whether a teacher checkpoint or the data files changed since a cache was built.
+    Paths that do not exist (e.g. a model name on the hub) are hashed by name only.
+    """
+    stats = []
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path))
+        for file in files:
+            if os.path.isfile(file):
+                stat = os.stat(file)
+                stats.append([file, stat.st_size, stat.st_mtime_ns])
+            else:
+                stats.append([file])
+    return hashlib.md5(json.dumps(stats).encode("utf-8")).hexdigest()
+
+
+def teacher_logits(teacher, batch_logits_fn: Callable, batch, topk: int = 0):
+    """Run the teacher on a batch without gradients.
+
+    Args:
+        teacher: Teacher model (in eval mode).
+        batch_logits_fn: Called as `batch_logits_fn(teacher, batch)`, returns (batch_size, seq_len, vocab_size) logits.
+        batch (dict): Batch from the train loader.
+        topk (int): Keep only the top-k logits per token; 0 keeps the full vocab.
+
+    Returns:
+        (values, indices): indices is None when `topk` is 0.
+    """
+    with torch.no_grad():
+        logits = batch_logits_fn(teacher, batch)
+    if topk <= 0:
+        return logits, None
+    values, indices = logits.topk(topk, dim=-1)
+    return values, indices
+
+
+class TeacherLogitCache:
+    """Top-k teacher logits for every training example, stored in memory-mapped files.
+
+    Files in `cache_dir`:
+        values.npy   float16 (num_examples, tgt_len, k)
+        indices.npy  int32   (num_examples, tgt_len, k)
+        meta.json    what the cache was built from; a cache is reused only if it matches
+    """
+    def __init__(self, cache_dir: str, teacher_name: str, data_dir: str, num_examples: int, src_len: int,
+                 tgt_len: int, topk: int):
+        """
+        Args:
+            cache_dir (str): Where to keep the cache.
+            teacher_name (str): Teacher model name or checkpoint dir.
+            data_dir (str): Data dir the train examples were read from.
+            num_examples (int): Number of train examples.
+            src_len (int), tgt_len (int): Source / target lengths the examples were tokenized to.
+            topk (int): Number of logits kept per token.
+        """
+        self.cache_dir = cache_dir
+        # the fingerprints catch a checkpoint rewritten in place (k_save_model) or changed data files
+        self.meta = {"teacher": teacher_name, "teacher_fingerprint": fingerprint([teacher_name]),
+                     "data_dir": os.path.abspath(data_dir),
+                     "data_fingerprint": fingerprint([os.path.join(data_dir, "train.source"),
+                                                      os.path.join(data_dir, "train.target")]),
+                     "num_examples": num_examples, "src_len": src_len, "tgt_len": tgt_len, "topk": topk}
+        self.values = None
+        self.indices = None
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.cache_dir, "meta.json")
+
+    def is_complete(self) -> bool:
+        if not os.path.exists(self.meta_path):
+            return False
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        return meta.pop("complete", False) and meta == self.meta
+
+    def build(self, teacher, loader, batch_logits_fn: Callable, log=None):
+        """Fill the cache by running the teacher over `loader` (whose batches contain "index")."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)   # an interrupted build must not look complete
+        shape = (self.meta["num_examples"], self.meta["tgt_len"], self.meta["topk"])
+        values = np.lib.format.open_memmap(os.path.join(self.cache_dir, "values.npy"), mode="w+",
+                                           dtype=np.float16, shape=shape)
+        indices = np.lib.format.open_memmap(os.path.join(self.cache_dir, "indices.npy"), mode="w+",
+                                            dtype=np.int32, shape=shape)
+        if log is not None:
+            log.info(f'Precomputing top-{self.meta["topk"]} teacher logits into {self.cache_dir}')
+
+        teacher.eval()
+        with tqdm(total=len(loader.dataset)) as progress_bar:
+            for batch in loader:
+                batch_values, batch_indices = teacher_logits(teacher, batch_logits_fn, batch, self.meta["topk"])
+                rows = batch["index"].numpy()
+                values[rows] = batch_values.cpu().numpy().astype(np.float16)
+                indices[rows] = batch_indices.cpu().numpy().astype(np.int32)
+                progress_bar.update(len(rows))
+
+        values.flush()
+        indices.flush()
+        del values, indices
+        with open(self.meta_path, "w") as f:
+            json.dump(dict(self.meta, complete=True), f, indent=2)
+
+    def open(self):
+        self.values = np.load(os.path.join(self.cache_dir, "values.npy"), mmap_mode="r")
+        self.indices = np.load(os.path.join(self.cache_dir, "indices.npy"), mmap_mode="r")
+
+    def lookup(self, indices: torch.Tensor, device) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Top-k (values, indices) for the examples at dataset `indices`, on `device`."""
+        rows = indices.numpy()
+        values = torch.from_numpy(self.values[rows].astype(np.float32)).to(device)
+        topk_ids = torch.from_numpy(self.indices[rows].astype(np.int64)).to(device)
+        return values, topk_ids
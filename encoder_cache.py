@@ -0,0 +1,140 @@
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+from typing import *
+
+import numpy as np
+import torch
+
+if TYPE_CHECKING:
+    from transformers.modeling_outputs import BaseModelOutput
+
+
+# 編碼器輸出緩存：當編碼器被凍結，或同一個dev集在每個epoch都要評估時，
+# 不需要每次都把1200個token的輸入重新跑一遍編碼器。
+# 緩存以樣本索引(index)為鍵，並帶有編碼器權重的版本號(version)；
+# 版本號改變時舊的緩存全部作廢。
+class EncoderCache:
+    """LRU cache of per-example encoder outputs with a memory-mapped disk spill.
+
+    Each entry is the encoder's last hidden state for one example, trimmed to the
+    unpadded length of the source (T5 pads on the right). When entries are read back
+    they are zero padded to the batch length; the padded positions are masked out in
+    cross attention by `attention_mask`, so the decoder sees exactly the same values.
+
+    Entries live on the CPU. Once `max_bytes` is exceeded the least recently used
+    entries are written to `spill_dir` as .npy files and read back with mmap.
+    """
+    def __init__(self, max_bytes: int, spill_dir: Optional[str] = None, version: str = ""):
+        """
+        Args:
+            max_bytes (int): Memory budget for the in-memory entries.
+            spill_dir (str): Directory to spill evicted entries to; None means evicted entries are dropped.
+            version (str): Identifies the encoder weights the cached outputs were computed with.
+        """
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.version = version
+
+        self.entries = OrderedDict()    # index -> tensor (seq_len x d_model), oldest first
+        self.num_bytes = 0
+        self.spilled = set()            # indices written to disk for the current version
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries) + len(self.spilled)
+
+    def set_version(self, version: str):
+        """Drop every entry if the encoder weights changed since they were cached."""
+        if version == self.version:
+            return
+        self.clear()
+        self.version = version
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+        self.spilled.clear()
+        if self.spill_dir is not None:
+            shutil.rmtree(self._version_dir(), ignore_errors=True)
+
+    def get(self, index: int) -> Optional[torch.Tensor]:
+        if index in self.entries:
+            self.entries.move_to_end(index)
+            return self.entries[index]
+        if index in self.spilled:
+            # copy-on-write mmap so torch gets a writable array without reading the whole file up front
+            return torch.from_numpy(np.load(self._spill_path(index), mmap_mode='c'))
+        return None
+
+    def put(self, index: int, hidden: torch.Tensor):
+        # copy, so the entry does not keep the whole padded batch output alive (on the CPU .to() returns a view)
+        hidden = hidden.detach().to("cpu", copy=True)
+        if index in self.entries:
+            self.num_bytes -= _nbytes(self.entries.pop(index))
+        self.entries[index] = hidden
+        self.num_bytes += _nbytes(hidden)
+
+        while self.num_bytes > self.max_bytes and self.entries:
+            old_index, old_hidden = self.entries.popitem(last=False)
+            self.num_bytes -= _nbytes(old_hidden)
+            if self.spill_dir is not None:
+                os.makedirs(self._version_dir(), exist_ok=True)
+                np.save(self._spill_path(old_index), old_hidden.numpy())
+                self.spilled.add(old_index)
+
+    def encode(self, model, src_ids: torch.Tensor, src_mask: torch.Tensor,
+               indices: torch.Tensor) -> "BaseModelOutput":
+        """Return encoder outputs for a batch, running the encoder only on the examples not cached.
+
+        Args:
+            model: Encoder-decoder model (we call `model.get_encoder()`).
+            src_ids (torch.Tensor): (batch_size, seq_len) source ids, already on the model's device.
+            src_mask (torch.Tensor): (batch_size, seq_len) attention mask for `src_ids`.
+            indices (torch.Tensor): (batch_size,) dataset index of every example in the batch.
+
+        Returns:
+            BaseModelOutput that can be passed as `encoder_outputs` to `model()` or `model.generate()`.
+        """
+        from transformers.modeling_outputs import BaseModelOutput
+
+        indices = indices.tolist()
+        hidden = [self.get(idx) for idx in indices]
+        missing = [i for i, h in enumerate(hidden) if h is None]
+        self.hits += len(indices) - len(missing)
+        self.misses += len(missing)
+
+        encoded = None
+        if missing:
+            with torch.no_grad():
+                encoded = model.get_encoder()(input_ids=src_ids[missing], attention_mask=src_mask[missing],
+                                              return_dict=True).last_hidden_state
+            lengths = src_mask[missing].sum(dim=1).tolist()
+            for row, (i, length) in enumerate(zip(missing, lengths)):
+                hidden[i] = encoded[row, :length]
+                self.put(indices[i], hidden[i])
+
+        if encoded is not None and len(missing) == len(indices):
+            # nothing was cached; use the encoder output as is
+            return BaseModelOutput(last_hidden_state=encoded)
+
+        batch_size, seq_len = src_ids.shape
+        d_model = hidden[0].shape[-1]
+        states = torch.zeros(batch_size, seq_len, d_model, dtype=hidden[0].dtype, device=src_ids.device)
+        for i, h in enumerate(hidden):
+            states[i, :h.shape[0]] = h.to(src_ids.device)
+        return BaseModelOutput(last_hidden_state=states)
+
+    def _version_dir(self):
+        # version strings may contain path separators (e.g. a checkpoint path)
+        return os.path.join(self.spill_dir, 'v-' + hashlib.md5(self.version.encode('utf-8')).hexdigest()[:12])
+
+    def _spill_path(self, index):
+        return os.path.join(self._version_dir(), f'{index}.npy')
+
+
+def _nbytes(tensor: torch.Tensor) -> int:
+    return tensor.element_size() * tensor.nelement()
@@ -0,0 +1,94 @@
+import queue
+import threading
+from collections import defaultdict
+from typing import *
+
+import torch
+
+
+# 訓練指標的緩衝區：loss保持為設備上的張量(不調用.item()，避免每一步都同步設備)，
+# 每N步才一次性拷貝到CPU，並由後台線程寫入TensorBoard/wandb。
+class MetricsBuffer:
+    """Buffer scalar metrics and write them to TensorBoard from a background thread.
+
+    Tensor values are kept on their device until `flush`, which copies each tag to the CPU
+    with a single transfer. With `resolution=1` every step is written, exactly as calling
+    `tbx.add_scalar` directly would; with `resolution=r` each point is the mean of r steps.
+
+    Usage:
+        metrics.add('train/loss', loss.detach(), step)
+        latest = metrics.step()     # dict of the latest values every `flush_every` steps, else None
+        ...
+        metrics.close()
+    """
+    def __init__(self, tbx, flush_every: int = 50, resolution: int = 1):
+        """
+        Args:
+            tbx (tensorboardX.SummaryWriter): Summary writer (wandb picks the scalars up through it when patched).
+            flush_every (int): Number of steps between flushes (i.e. device syncs).
+            resolution (int): Number of steps averaged into each logged point.
+        """
+        self.tbx = tbx
+        self.flush_every = flush_every
+        self.resolution = resolution
+
+        self.pending = defaultdict(list)    # tag -> list of (step, value)
+        self.num_steps = 0
+
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def add(self, tag: str, value: Union[torch.Tensor, float], step: int):
+        self.pending[tag].append((step, value))
+
+    def step(self) -> Optional[Dict[str, float]]:
+        """Mark the end of a training step; flushes every `flush_every` steps."""
+        self.num_steps += 1
+        if self.num_steps % self.flush_every == 0:
+            return self.flush()
+        return None
+
+    def flush(self, partial: bool = False) -> Dict[str, float]:
+        """Send buffered values to the writer thread.
+
+        Args:
+            partial (bool): Also write a trailing group of fewer than `resolution` steps.
+
+        Returns:
+            latest (dict): The mean of each tag over the flushed steps, e.g. for a progress bar.
+        """
+        latest = {}
+        for tag, items in self.pending.items():
+            num_ready = len(items) if partial else len(items) - len(items) % self.resolution
+            if num_ready == 0:
+                continue
+            ready, self.pending[tag] = items[:num_ready], items[num_ready:]
+
+            steps = [step for step, _ in ready]
+            values = [value for _, value in ready]
+            if isinstance(values[0], torch.Tensor):
+                values = torch.stack([v.float() for v in values]).cpu().tolist()   # one sync per tag
+
+            points = []
+            for start in range(0, num_ready, self.resolution):
+                group = values[start:start + self.resolution]
+                points.append((steps[start + len(group) - 1], sum(group) / len(group)))
+            self.queue.put((tag, points))
+            latest[tag] = sum(values) / len(values)
+        return latest
+
+    def close(self):
+        """Write everything that is left and wait for the writer thread."""
+        self.flush(partial=True)
+        self.queue.put(None)
+        self.writer.join()
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            tag, points = item
+            for step, value in points:
+                self.tbx.add_scalar(tag, value, step)
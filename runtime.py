@@ -0,0 +1,210 @@
+import functools
+import glob
+import os
+import re
+import time
+from typing import *
+
+import torch
+
+
+# CPU運行時配置：把CPU核心分給計算線程(intra-op threads)和DataLoader的workers，
+# 避免兩者搶佔同一批核心，並按NUMA節點綁定。
+
+
+class CpuPlan(NamedTuple):
+    compute_cpus: List[int]         # cores for the main process / torch intra-op threads
+    worker_cpus: List[List[int]]    # cores for each DataLoader worker; each list is on a single NUMA node
+
+
+def get_numa_nodes() -> List[List[int]]:
+    """Get the usable cores of every NUMA node.
+
+    Returns:
+        nodes (list): One list of core ids per NUMA node, restricted to the cores this process may run on.
+            Falls back to a single node when the topology is not available (e.g. not on Linux).
+    """
+    available = _available_cpus()
+    nodes = []
+    for node_dir in sorted(glob.glob("/sys/devices/system/node/node[0-9]*"),
+                           key=lambda d: int(re.search(r"(\d+)$", d).group(1))):
+        try:
+            with open(os.path.join(node_dir, "cpulist")) as f:
+                cpus = [cpu for cpu in _parse_cpulist(f.read()) if cpu in available]
+        except OSError:
+            continue
+        if cpus:
+            nodes.append(cpus)
+
+    if not nodes:
+        nodes = [sorted(available)]
+    return nodes
+
+
+def plan_cpus(num_workers: int, nodes: Optional[List[List[int]]] = None) -> CpuPlan:
+    """Split cores between compute threads and `num_workers` DataLoader workers.
+
+    Worker cores are taken from the end of the last NUMA node first so that node 0, where the
+    main process allocates the model, keeps as many compute cores as possible. Each worker gets
+    cores from one node only. At least one core is always left for compute.
+    """
+    if nodes is None:
+        nodes = get_numa_nodes()
+    all_cpus = [cpu for node in nodes for cpu in node]
+    if num_workers <= 0 or len(all_cpus) < 2:
+        return CpuPlan(compute_cpus=all_cpus, worker_cpus=[])
+
+    # one core per worker, but never more than half the machine
+    num_loader_cpus = min(num_workers, len(all_cpus) // 2)
+
+    loader_nodes = []   # cores taken for loaders, grouped by node
+    remaining = num_loader_cpus
+    for node in reversed(nodes):
+        if remaining == 0:
+            break
+        take = node[-remaining:] if remaining < len(node) else list(node)
+        loader_nodes.append(take)
+        remaining -= len(take)
+
+    loader_cpus = {cpu for node in loader_nodes for cpu in node}
+    compute_cpus = [cpu for cpu in all_cpus if cpu not in loader_cpus]
+
+    # hand out loader cores round robin; workers sharing a node share that node's cores
+    worker_cpus = []
+    for worker_id in range(num_workers):
+        node = loader_nodes[worker_id % len(loader_nodes)]
+        worker_cpus.append(node)
+    return CpuPlan(compute_cpus=compute_cpus, worker_cpus=worker_cpus)
+
+
+def configure_cpus(plan: CpuPlan):
+    """Pin the main process to the compute cores and size torch's thread pool to match."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, plan.compute_cpus)
+    torch.set_num_threads(len(plan.compute_cpus))
+
+
+def loader_kwargs(num_workers: int, plan: Optional[CpuPlan] = None, prefetch_factor: int = 2,
+                  persistent_workers: bool = True) -> Dict[str, Any]:
+    """Keyword arguments for `DataLoader`.
+
+    Workers are kept alive across epochs instead of being re-forked every epoch, and memory is
+    pinned when there is a GPU to copy to. With a `plan`, every worker is pinned to its cores.
+    """
+    kwargs = {"num_workers": num_workers, "pin_memory": torch.cuda.is_available()}
+    if num_workers > 0:
+        kwargs["persistent_workers"] = persistent_workers
+        kwargs["prefetch_factor"] = prefetch_factor
+        if plan is not None and plan.worker_cpus:
+            kwargs["worker_init_fn"] = functools.partial(_init_worker, plan.worker_cpus)
+    return kwargs
+
+
+class LoaderTimer:
+    """Measure how long the training loop waits on the DataLoader.
+
+    Usage:
+        for batch in timer.wrap(loader): ...
+    """
+    def __init__(self):
+        self.stall_secs = 0.0
+        self.total_secs = 0.0
+        self.num_batches = 0
+
+    def reset(self):
+        self.__init__()
+
+    def wrap(self, loader):
+        start = time.perf_counter()
+        it = iter(loader)
+        while True:
+            wait_start = time.perf_counter()
+            try:
+                batch = next(it)
+            except StopIteration:
+                break
+            self.stall_secs += time.perf_counter() - wait_start
+            self.num_batches += 1
+            yield batch
+        self.total_secs += time.perf_counter() - start
+
+    @property
+    def stall_fraction(self):
+        return self.stall_secs / self.total_secs if self.total_secs > 0 else 0.0
+
+
+def autotune(make_loader: Callable[[Dict[str, Any]], Iterable], step_fn: Callable[[Any], None],
+             candidates: Iterable[int], num_batches: int = 10, nodes: Optional[List[List[int]]] = None,
+             log=None) -> Tuple[int, CpuPlan]:
+    """Pick the number of DataLoader workers (and matching core split) that trains fastest.
+
+    Args:
+        make_loader: Builds a loader from `loader_kwargs(...)`.
+        step_fn: Runs one training step on a batch.
+        candidates: Worker counts to try.
+        num_batches (int): Batches to time per candidate (after one warm-up batch).
+        nodes (list): NUMA topology from `get_numa_nodes()`. Pass it if this process may already be pinned
+            (`configure_cpus`), since the topology is read through this process's CPU affinity.
+        log (logging.Logger): Optional logger for the timings.
+
+    Returns:
+        (num_workers, plan) of the fastest candidate. The caller should `configure_cpus(plan)`.
+    """
+    # read the topology once; configure_cpus() below narrows what this process can see
+    if nodes is None:
+        nodes = get_numa_nodes()
+    best = None
+    for num_workers in candidates:
+        plan = plan_cpus(num_workers, nodes)
+        configure_cpus(plan)
+        loader = make_loader(loader_kwargs(num_workers, plan, persistent_workers=False))
+
+        it = iter(loader)
+        step_fn(next(it))   # warm up (and let the workers start)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        timed = 0
+        for batch in it:
+            step_fn(batch)
+            timed += 1
+            if timed == num_batches:
+                break
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()    # otherwise we only time how fast kernels are queued
+        secs_per_batch = (time.perf_counter() - start) / max(timed, 1)
+        del it, loader
+
+        if log is not None:
+            log.info(f'autotune: workers={num_workers}, compute threads={len(plan.compute_cpus)}: '
+                     f'{secs_per_batch * 1000:.1f} ms/batch')
+        if best is None or secs_per_batch < best[0]:
+            best = (secs_per_batch, num_workers, plan)
+
+    return best[1], best[2]
+
+
+def _init_worker(worker_cpus, worker_id):
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, worker_cpus[worker_id])
+    torch.set_num_threads(1)
+
+
+def _available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return set(os.sched_getaffinity(0))
+    return set(range(os.cpu_count() or 1))
+
+
+def _parse_cpulist(cpulist: str) -> List[int]:
+    """Parse a kernel cpulist such as "0-3,8-11"."""
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-")
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
@@ -0,0 +1,113 @@
+import math
+from typing import *
+
+import torch
+from torch.utils.data import Sampler
+
+
+# 訓練樣本的採樣策略：
+# - curriculum: 先訓練短的樣本，再逐步加入長的樣本
+# - loss: 按每個樣本的loss做重要性採樣(loss越大越常被採到)，並用權重修正偏差
+# 每個樣本的loss統計保存在設備上，不需要每一步都同步。
+
+
+class ExampleLossTracker:
+    """Running (exponential moving average) loss of every training example, kept on the device."""
+    def __init__(self, num_examples: int, device, momentum: float = 0.9):
+        self.momentum = momentum
+        self.loss = torch.zeros(num_examples, device=device)
+        self.seen = torch.zeros(num_examples, dtype=torch.bool, device=device)
+
+    def update(self, indices: torch.Tensor, losses: torch.Tensor):
+        """
+        Args:
+            indices (torch.Tensor): (batch_size,) dataset indices.
+            losses (torch.Tensor): (batch_size,) loss of each example, e.g. from `util.per_example_loss`.
+        """
+        indices = indices.to(self.loss.device)
+        losses = losses.detach().float()
+        old = self.loss[indices]
+        new = torch.where(self.seen[indices], self.momentum * old + (1 - self.momentum) * losses, losses)
+        self.loss[indices] = new
+        self.seen[indices] = True
+
+
+class CurriculumSampler(Sampler):
+    """Train on the shortest examples first and add longer ones as training goes on.
+
+    At epoch e (starting at 1) the pool is the shortest `c(e)` fraction of the examples with
+        c(e) = min(1, start_fraction + (1 - start_fraction) * (e - 1) / num_warmup_epochs)
+    and it is shuffled, so after `num_warmup_epochs` this is the usual uniform shuffle.
+    """
+    def __init__(self, lengths: List[int], start_fraction: float = 0.3, num_warmup_epochs: int = 5, seed: int = 0):
+        self.order = sorted(range(len(lengths)), key=lambda i: lengths[i])    # short to long
+        self.start_fraction = start_fraction
+        self.num_warmup_epochs = num_warmup_epochs
+        self.seed = seed
+        self.epoch = 1
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.epoch_length(self.epoch)
+
+    def epoch_length(self, epoch: int) -> int:
+        """Number of examples drawn in `epoch` (e.g. to size the LR schedule)."""
+        competence = min(1.0, self.start_fraction
+                         + (1 - self.start_fraction) * (epoch - 1) / max(self.num_warmup_epochs, 1))
+        return max(1, math.ceil(competence * len(self.order)))
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        pool = self.order[:len(self)]
+        for i in torch.randperm(len(pool), generator=generator).tolist():
+            yield pool[i]
+
+
+class LossWeightedSampler(Sampler):
+    """Sample examples with probability increasing with their running loss.
+
+    p_i = (1 - smoothing) * loss_i^alpha / sum_j loss_j^alpha + smoothing / n
+
+    Examples that have not been seen yet get the largest loss seen so far, so every example is
+    visited early on (the first epoch, with nothing seen, is uniform). Sampling is with
+    replacement, so the summed token loss of each example must be scaled by
+    `weights[index]` = 1 / (n * p_i) before dividing by the batch's token count; that keeps the
+    gradient an unbiased estimate of the uniform one, and equal weights give back the usual loss.
+    """
+    def __init__(self, tracker: ExampleLossTracker, alpha: float = 1.0, smoothing: float = 0.1, seed: int = 0):
+        self.tracker = tracker
+        self.alpha = alpha
+        self.smoothing = smoothing
+        self.seed = seed
+        self.epoch = 1
+
+        num_examples = len(tracker.loss)
+        self.weights = torch.ones(num_examples)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.weights)
+
+    def epoch_length(self, epoch: int) -> int:
+        return len(self.weights)
+
+    def __iter__(self):
+        num_examples = len(self.weights)
+        loss = self.tracker.loss.cpu()      # one device sync per epoch
+        seen = self.tracker.seen.cpu()
+        if seen.any():
+            loss = torch.where(seen, loss, loss[seen].max())
+            priority = loss.clamp(min=1e-6) ** self.alpha
+            probs = (1 - self.smoothing) * priority / priority.sum() + self.smoothing / num_examples
+        else:
+            probs = torch.full((num_examples,), 1.0 / num_examples)
+        self.weights = 1.0 / (num_examples * probs)
+
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        yield from torch.multinomial(probs, num_examples, replacement=True, generator=generator).tolist()
@@ -0,0 +1,56 @@
+import json
+import os
+import sys
+from typing import *
+
+
+# 記錄dev NLL第一次達到目標值時的步數，用來比較不同採樣策略(sampling.py)的收斂速度。
+# 這個文件不導入torch，命令行比較結果時啟動很快。
+
+
+class StepsToTarget:
+    """Record the first optimizer step at which the dev NLL reaches a target.
+
+    The result is written to `steps_to_target.json` in the record dir so runs with different
+    samplers can be compared with `python steps_to_target.py <record_dir> <record_dir> ...`.
+    """
+    def __init__(self, target_nll: float, sampler_name: str, record_dir: str):
+        self.target_nll = target_nll
+        self.sampler_name = sampler_name
+        self.save_path = os.path.join(record_dir, "steps_to_target.json")
+        self.reached = None
+
+    def update(self, dev_nll: float, optim_step: int, example_step: int, epoch: int) -> bool:
+        """Returns True the first time `dev_nll` is at or below the target."""
+        if self.reached is not None or dev_nll > self.target_nll:
+            return False
+        self.reached = {"sampler": self.sampler_name, "target_nll": self.target_nll, "dev_nll": dev_nll,
+                        "optim_steps": optim_step, "examples": example_step, "epoch": epoch}
+        with open(self.save_path, "w") as f:
+            json.dump(self.reached, f, indent=2)
+        return True
+
+
+def compare_steps_to_target(record_dirs: List[str]) -> List[Dict[str, Any]]:
+    """Load `steps_to_target.json` from each run; runs that never reached the target get None steps."""
+    rows = []
+    for record_dir in record_dirs:
+        path = os.path.join(record_dir, "steps_to_target.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                row = json.load(f)
+        else:
+            row = {"sampler": "?", "optim_steps": None}
+        row["record_dir"] = record_dir
+        rows.append(row)
+    return rows
+
+
+if __name__ == '__main__':
+    # e.g. python steps_to_target.py "save/Text Summarization-01" "save/Text Summarization-02"
+    rows = compare_steps_to_target(sys.argv[1:])
+    baseline = next((r["optim_steps"] for r in rows if r["sampler"] == "uniform" and r["optim_steps"]), None)
+    for row in rows:
+        steps = row["optim_steps"]
+        speedup = f'{baseline / steps:.2f}x vs uniform' if baseline and steps else ""
+        print(f'{row["record_dir"]}\t{row["sampler"]}\t{steps if steps else "not reached"}\t{speedup}')
@@ -1,23 +1,19 @@
+import atexit
+import copy
+import os
+import shutil
 import socket
+import tempfile
 from collections import OrderedDict
-from pathlib import Path
 from typing import *
 
-import torch
-import torch.nn as nn
-import wandb
-from tensorboardX import SummaryWriter
-from torch.utils.data import DataLoader, Dataset
-from tqdm import tqdm
-from transformers import (
-    AdamW,
-    T5ForConditionalGeneration,
-    T5Tokenizer,
-    get_linear_schedule_with_warmup
-)
-
+# torch, transformers, wandb and tensorboardX (and our modules that use torch) are slow to import, so they are
+# imported where they are used; importing this file (e.g. to read the config) stays cheap
 import util
 
+if TYPE_CHECKING:
+    from encoder_cache import EncoderCache
+
 # Configuration details. These could be passed as command line arguments but are done this way
 # for simplicity.
 kname = "Text Summarization"
@@ -50,8 +46,16 @@ k_num_train = -1      # -1 is use all
 k_num_val = -1
 k_batch_size = 16
 k_num_workers = 4     # num of workers for dataloader
+k_prefetch_factor = 2       # batches loaded in advance by each worker
+k_pin_cpus = False          # split cores between torch threads and loader workers, pinned by NUMA node
+k_autotune_runtime = False  # time a few training steps with different worker counts and keep the fastest
+k_autotune_workers = [0, 1, 2, 4, 8]
+k_autotune_batches = 10
 
 k_use_wandb = False # whether to log to wandb (you'll need to set up wandb env info)
+k_use_tensorboard = True    # wandb logs through tensorboard, so it is always on with wandb
+k_log_every = 50        # train metrics are copied off the device and written every k_log_every batches
+k_log_resolution = 1    # batches averaged into each logged point (1 logs every batch)
 
 # source and target lengths for dataloader. If you know your lengths you can change these, or
 # add a collate function to handle different sizes. Depending on your inputs you should change these.
@@ -60,6 +64,39 @@ k_max_tgt_len = 120
 
 k_seed = 42
 
+# Training order. "uniform" shuffles every epoch; "curriculum" starts with the shortest sources and adds longer
+# ones over k_curriculum_epochs; "loss" samples examples by their running loss (with importance weights).
+k_sampler = "uniform"
+k_curriculum_start = 0.3            # fraction of the (shortest) examples used in the first epoch
+k_curriculum_epochs = 5
+k_loss_sampler_alpha = 1.0          # sampling probability ~ loss ** alpha
+k_loss_sampler_smoothing = 0.1      # mixed with this much of the uniform distribution
+k_target_dev_nll = None             # if set, log the step at which dev NLL first reaches it
+
+# Knowledge distillation. Setting k_teacher_model (e.g. a save dir written with k_save_model) trains k_model as a
+# student on loss = alpha * KL(teacher || student) + (1 - alpha) * label loss.
+k_teacher_model = None
+k_distill_alpha = 0.5
+k_distill_temperature = 2.0
+k_distill_topk = 16             # keep the teacher's top-k logits per token; 0 uses the full vocab (on the fly only)
+k_distill_cache_dir = None      # precompute the top-k logits into this dir once; None computes them on the fly
+k_latency_examples = 8          # dev examples timed one at a time for the inference latency metric
+k_latency_device = "cpu"        # where latency is measured (we serve on the CPU), whatever device trains
+k_save_model = False            # save the model (and tokenizer) to <record_dir>/model after every epoch
+
+# pretrained weights are saved here as safetensors on first use and memory-mapped on later runs; None to disable
+k_weights_dir = "./save/pretrained"
+
+# Encoder output cache. With a frozen encoder (or when the dev set is evaluated with different decoding
+# settings) the encoder output for an example does not change, so we can skip the encoder on repeated passes.
+# Freezing the encoder gives it a frozen copy of the token embeddings; the shared embeddings used by the decoder
+# (and lm_head) keep training.
+k_freeze_encoder = False
+k_use_encoder_cache = False
+k_encoder_cache_mb = 4096       # in-memory budget per split; least recently used entries spill to disk
+k_encoder_cache_dir = None      # where to spill; None means k_save_dir. Never the record dir: wandb uploads that
+k_check_encoder_cache = True    # on the first dev batch, check that cached and uncached loss / generate agree
+
 all_config = {
     "save_dir": k_save_dir,
     "data_dir": k_data_dir,
@@ -69,153 +106,36 @@ all_config = {
     "adam_eps": k_adam_eps,
     "warmup": k_warmup_steps,
     "workers": k_num_workers,
+    "prefetch_factor": k_prefetch_factor,
+    "pin_cpus": k_pin_cpus,
+    "autotune_runtime": k_autotune_runtime,
+    "log_every": k_log_every,
+    "log_resolution": k_log_resolution,
     "max grad": k_max_grad_norm,
     "num_train": k_num_train,
     "num_val": k_num_val,
     "batch_size": k_batch_size,
     "max_src_len": k_max_src_len,
-    "max_tgt_len": k_max_tgt_len
+    "max_tgt_len": k_max_tgt_len,
+    "sampler": k_sampler,
+    "target_dev_nll": k_target_dev_nll,
+    "teacher_model": k_teacher_model,
+    "distill_alpha": k_distill_alpha,
+    "distill_temperature": k_distill_temperature,
+    "distill_topk": k_distill_topk,
+    "latency_device": k_latency_device,
+    "freeze_encoder": k_freeze_encoder,
+    "encoder_cache": k_use_encoder_cache,
+    "encoder_cache_mb": k_encoder_cache_mb,
+    "check_encoder_cache": k_check_encoder_cache
 }
 
 
-# A dataset for our inputs.
-class T5DataSet(Dataset):
-    def __init__(self, tokenizer, data_dir: str, type_path, max_examples=-1,
-                 max_src_len=2000, max_tgt_len=500):
-        """
-        max_examples: if > 0 then will load only max_examples into the dataset; -1 means use all
-
-        max_src and max_tgt len refer to number of tokens in the input sequences
-        # Note: these are not randomized. If they were we might need to collate.
-        """
-
-        valid_type_paths = ["test", "train", "val"]
-        assert type_path in valid_type_paths, f"Type path must be one of {valid_type_paths}"
-
-        self.example_path = Path(data_dir) / type_path
-        self.max_examples = max_examples
-        self.tokenizer = tokenizer
-
-        self.max_src_len = max_src_len  # max num of tokens in tokenize()
-        self.max_tgt_len = max_tgt_len
-
-        self.inputs = []            # list of dict
-        self.targets = []           # list of dict
-        self.input_text = []        # list of str
-        self.target_text = []       # list of str
-
-        self._build()       # fill inputs, targets, max_lens
-
-    def __len__(self):
-        return len(self.inputs)
-
-    # __getitem__方法用於根據索引從數據集中獲取一個樣本。
-    def __getitem__(self, index):
-        source_ids = self.inputs[index]["input_ids"].squeeze()
-        target_ids = self.targets[index]["input_ids"].squeeze()
-
-        src_mask    = self.inputs[index]["attention_mask"].squeeze()  # might need to squeeze
-        target_mask = self.targets[index]["attention_mask"].squeeze()  # might need to squeeze
-
-        src_text = self.input_text[index]
-        tgt_text = self.target_text[index]
-
-        # These will be cast to torch.long in forward
-        return {"source_ids": source_ids, "source_mask": src_mask,
-                "target_ids": target_ids, "target_mask": target_mask,
-                "source_text": src_text, "target_text": tgt_text}
-
-    # _build方法用於構建數據集，從源文本文件和目標文本文件中讀取文本數據。
-    def _build(self):
-        source_path = self.example_path.with_suffix(".source")
-        target_path = self.example_path.with_suffix(".target")
-
-        with open(source_path, 'r') as f_source, \
-                open(target_path, 'r') as f_target:
-
-            source, target = f_source.readlines(), f_target.readlines()
-            source_ct, target_ct = len(source), len(target)
-
-            # for i in range(min(source_ct, target_ct)):
-            #     print("Source Line", i + 1, ":", source[i])
-            #     print("Target Line", i + 1, ":", target[i])
-
-
-            assert source_ct == target_ct, f"Lengths don't match"
-            # Note we could batch encode
-            log.warning(f'Using max_src_len, max_tgt_len = ({self.max_src_len}, {self.max_tgt_len})')
-
-            inputs_out = []     # accumulate the output of batch_encode
-            targets_out = []    # same
-            inputs_text = []    # save the original text for evaluations
-            targets_text = []   # same
-
-            if self.max_examples > 0 :
-                source_ct = min(self.max_examples, source_ct)
-
-            for idx in range(source_ct):
-                # append end of sequence tokens (not necessary) because handled by tokenize() call
-
-                src = source[idx].strip()
-                tgt = target[idx].strip()
-                # 去除源文本和目標文本的首尾空格
-                # 將處理後的文本添加到inputs_text和targets_text列表中。
-                inputs_text.append(src)
-                targets_text.append(tgt)
-
-                # tokenize
-                # padding="max_length" pads to max_len
-                # 如果使用padding = "max_length"會將序列填充到最大長度
-                # otherwise (e.g. for batch), we could use padding=longest with truncation
-                # note: don't need add_special_tokens since EOS added automatically and others are PAD
-                # self.tokenizer returns a dict of input_ids and attention_masks (where attn masks corresponds to padding)
-                # self.tokenizer會返回一個字典，包含input_ids和attention_masks，
-                # 其中注意力遮罩（attention_masks）對應填充部分
-                # Note: padding could also be done via collate in dataloader
-                # todo: we could actually batch encode these (i.e. multiple per)
-                tokenized_inputs = self.tokenizer(
-                    [src], max_length=self.max_src_len, padding="max_length", return_tensors="pt", truncation=True
-                )
-
-                # src: 要進行處理的原始文本。
-                # max_length: 設定輸出的序列的最大長度。如果原始文本超過該長度，將進行截斷；如果不足該長度，將進行填充。
-                # padding: 填充方式的設定。在這裡，使用 "max_length"，
-                # 表示將序列填充到 max_length長度。
-                # return_tensors: 設定返回的張量類型。這裡使用 "pt"
-                # 表示返回PyTorch張量。
-                # truncation: 是否進行截斷。在這裡，我們將文本截斷到max_length長度。
-                tokenized_targets = self.tokenizer(
-                    [tgt], max_length=self.max_tgt_len, padding="max_length", return_tensors="pt", truncation=True
-                )
-                inputs_out.append(tokenized_inputs)
-                targets_out.append(tokenized_targets)
-            self.inputs = inputs_out
-            self.targets = targets_out
-            self.input_text = inputs_text
-            self.target_text = targets_text
-
-
-def get_dataloaders(tokenizer, batch_size, num_train, num_val, data_dir, num_workers, shuffle_train=True,
-                    shuffle_dev=False) -> Tuple[DataLoader, DataLoader]:
-    """
-    Returns: Tuple[train_loader : DataLoader, dev_loader : DataLoader]
-    # Note:
-    # - we default to not shuffling the dev set
-
-    """
-    # todo: should pass max src and max tgt len in as arguments
-    train_data_set = T5DataSet(tokenizer, type_path="train", data_dir=data_dir, max_examples=num_train,
-                               max_src_len=k_max_src_len, max_tgt_len=k_max_tgt_len)
-    eval_data_set = T5DataSet(tokenizer, type_path="val", data_dir=data_dir, max_examples=num_val,
-                              max_src_len=k_max_src_len, max_tgt_len=k_max_tgt_len)
-    train_loader = DataLoader(train_data_set, batch_size=batch_size, shuffle=shuffle_train, num_workers=num_workers)
-    eval_loader = DataLoader(eval_data_set, batch_size=batch_size, shuffle=shuffle_dev, num_workers=num_workers)
-    log.info(f'Datasets loaded with sizes: train: {len(train_data_set)}, dev: {len(eval_data_set)}')
-
-    return train_loader, eval_loader
-
+def forward(model, device, batch, encoder_cache: Optional["EncoderCache"] = None, per_example=False):
+    # per_example: also return the summed token loss of every example in the batch (on the device; dividing the
+    # sum of these by the batch's token count gives `loss`; see util.per_example_loss)
+    import torch
 
-def forward(model, device, batch):
     # 将批次数据中的"source_ids"取出，并将其转移到指定的计算设备上
     # （通过to(device)）。数据类型被设置为torch.long，下同。
     src_ids = batch["source_ids"].to(device, dtype=torch.long)
@@ -225,9 +145,11 @@ def forward(model, device, batch):
     # padded ids (pad=0) are set to -100, which means ignore for loss calculation
     #将"target_ids"中的值为0的填充标记（pad）替换为 - 100。
     # 这是为了在损失计算中忽略填充标记对损失的贡献。
-    tgt_ids[tgt_ids[: ,:] == 0 ] = -100
+    # masked_fill returns a new tensor: on the CPU .to() above returns batch["target_ids"] itself, and changing it
+    # in place would also change the labels of any earlier forward() on this batch (e.g. the student's, when the
+    # teacher runs on the same batch for distillation), which autograd still needs for backward
+    label_ids = tgt_ids.masked_fill(tgt_ids == 0, -100)
     #tips：填充标记通常用值为0的特殊标记来表示
-    label_ids = tgt_ids.to(device)
     # when we call model() with labels, they will be
     # - automatically right shifted by 1 (for teacher forcing)
     # "right shifted by 1"，意味着在训练过程中，模型的输入序列会向右移动一个位置，
@@ -235,42 +157,177 @@ def forward(model, device, batch):
     # - prepended by BOS=Beginning of sequence which is a PAD token
     # - any token that was -100 will be masked_fill_ to <pad> for teacher forcing
     # return_dict means return as a dictionary
-    out_dict = model(src_ids, attention_mask=src_mask, labels=label_ids, return_dict=True)
+    if encoder_cache is not None:
+        # 使用緩存的編碼器輸出，只有未緩存的樣本才會經過編碼器
+        encoder_outputs = encoder_cache.encode(model, src_ids, src_mask, batch["index"])
+        out_dict = model(attention_mask=src_mask, encoder_outputs=encoder_outputs, labels=label_ids,
+                         return_dict=True)
+    else:
+        out_dict = model(src_ids, attention_mask=src_mask, labels=label_ids, return_dict=True)
     #src_ids：输入的源序列的标识符。它是一个张量（tensor），其中包含了将要输入到模型中的源序列。
     #attention_mask：源序列的注意力掩码。它是一个张量，用于指示哪些位置需要被注意力机制考虑，哪些位置应该被忽略。通常情况下，它与输入序列的长度相同，为1表示需要考虑该位置，为0表示忽略该位置。
     #labels：目标序列的标识符。它是一个张量，其中包含了模型需要预测的目标序列。在训练过程中，使用真实的目标序列作为标签进行模型的监督学习。
     #return_dict = True：这是一个布尔值参数，用于指定是否以字典的形式返回模型的输出结果。当设置为True时，模型的输出将以字典的形式返回，其中包含了各种结果，如损失值、预测结果等。如果设置为False，则模型的输出将以其他形式（如元组）返回
     loss, logits = out_dict['loss'], out_dict['logits']
+    if per_example:
+        return loss, logits, util.per_example_loss(logits, label_ids, reduction="sum")
     return loss, logits
 
 
 
 
 def main():
+    import torch
+    import torch.nn as nn
+    from torch.utils.data import DataLoader
+    from tqdm import tqdm
+    from transformers import (
+        AdamW,
+        T5ForConditionalGeneration,
+        T5Tokenizer,
+        get_linear_schedule_with_warmup
+    )
+
+    import distill
+    import runtime
+    import sampling
+    import steps_to_target as target_report
+    from dataset import get_dataloaders
+    from encoder_cache import EncoderCache
+    from metrics import MetricsBuffer
+
     util.set_seed(k_seed)
     device, gpu_ids = util.get_available_devices()
+
+    num_workers = k_num_workers
+    cpu_plan = None
+    # read before any pinning: the topology is seen through this process's CPU affinity
+    numa_nodes = runtime.get_numa_nodes()
+    if k_pin_cpus:
+        cpu_plan = runtime.plan_cpus(num_workers, numa_nodes)
+        runtime.configure_cpus(cpu_plan)
     ###从预训练模型中加载T5条件生成模型以及分词器
-    model = T5ForConditionalGeneration.from_pretrained(k_model)
+    model = util.load_pretrained(T5ForConditionalGeneration, k_model, k_weights_dir)
     tokenizer = T5Tokenizer.from_pretrained(k_model)
 
+    loss_tracker = None
+
+    def make_train_sampler(data_set):
+        nonlocal loss_tracker
+        if k_sampler == "curriculum":
+            lengths = [int(x["attention_mask"].sum()) for x in data_set.inputs]
+            return sampling.CurriculumSampler(lengths, start_fraction=k_curriculum_start,
+                                              num_warmup_epochs=k_curriculum_epochs, seed=k_seed)
+        elif k_sampler == "loss":
+            loss_tracker = sampling.ExampleLossTracker(len(data_set), device)
+            return sampling.LossWeightedSampler(loss_tracker, alpha=k_loss_sampler_alpha,
+                                                smoothing=k_loss_sampler_smoothing, seed=k_seed)
+        else:
+            raise ValueError(f"Invalid sampler {k_sampler}")
+
     train_loader, dev_loader = \
         get_dataloaders(tokenizer, batch_size=k_batch_size, num_train=k_num_train, num_val=k_num_val,
-                        data_dir=k_data_dir, num_workers=k_num_workers)
+                        data_dir=k_data_dir, num_workers=num_workers,
+                        max_src_len=k_max_src_len, max_tgt_len=k_max_tgt_len,
+                        loader_kwargs=runtime.loader_kwargs(num_workers, cpu_plan, k_prefetch_factor),
+                        train_sampler_fn=None if k_sampler == "uniform" else make_train_sampler)
+    train_sampler = train_loader.sampler
 
     # reset in case we used the -1 flag for all
     num_train = len(train_loader.dataset)
     num_val = len(dev_loader.dataset)
-    total_steps = ( (num_train // k_batch_size) * k_epochs)     # num times that optim.step() will be called
-    total_train = num_train * k_epochs
+    # samplers can draw a different number of examples each epoch (e.g. the curriculum starts small)
+    if hasattr(train_sampler, "epoch_length"):
+        epoch_lengths = [train_sampler.epoch_length(epoch) for epoch in range(1, k_epochs + 1)]
+    else:
+        epoch_lengths = [num_train] * k_epochs
+    total_steps = sum(length // k_batch_size for length in epoch_lengths)  # num times that optim.step() will be called
+    total_train = sum(epoch_lengths)
 
     model.to(device)
 
-    optimizer = AdamW(model.parameters(), lr=k_lr, eps=k_adam_eps)
+    if k_freeze_encoder:
+        # T5 ties the encoder's input embeddings to `shared`, which the decoder and lm_head also use. Untie them so
+        # the decoder side keeps training while the encoder (and so its cached outputs) stays fixed.
+        encoder = model.get_encoder()
+        encoder.set_input_embeddings(copy.deepcopy(model.shared))
+        for param in encoder.parameters():
+            param.requires_grad = False
+
+    train_cache, dev_cache = None, None
+    if k_use_encoder_cache:
+        # spill to a fresh dir outside record_dir (wandb uploads everything in wandb.run.dir), removed when the run
+        # ends; spilled entries are only valid within this run anyway
+        spill_base = k_encoder_cache_dir or k_save_dir
+        os.makedirs(spill_base, exist_ok=True)
+        cache_dir = tempfile.mkdtemp(prefix="encoder_cache-", dir=spill_base)
+        atexit.register(shutil.rmtree, cache_dir, ignore_errors=True)
+        cache_bytes = k_encoder_cache_mb * 1024 * 1024
+        # a trainable encoder changes every step, so caching training inputs would never hit
+        if k_freeze_encoder:
+            train_cache = EncoderCache(cache_bytes, os.path.join(cache_dir, "train"), version=k_model)
+        dev_cache = EncoderCache(cache_bytes, os.path.join(cache_dir, "val"))
+
+    optimizer = AdamW([p for p in model.parameters() if p.requires_grad], lr=k_lr, eps=k_adam_eps)
     scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=k_warmup_steps,
                                                 num_training_steps=total_steps)
 
+    if k_autotune_runtime:
+        def make_loader(kwargs):
+            return DataLoader(train_loader.dataset, batch_size=k_batch_size, shuffle=True, **kwargs)
+
+        def train_step(batch):
+            # forward + backward without an optimizer step, so the weights are left untouched. No encoder cache:
+            # candidates tried later would get cache hits and look faster.
+            loss, _ = forward(model, device, batch)
+            loss.backward()
+            optimizer.zero_grad()
+
+        model.train()
+        if k_freeze_encoder:
+            model.get_encoder().eval()
+        num_workers, cpu_plan = runtime.autotune(make_loader, train_step, k_autotune_workers,
+                                                 num_batches=k_autotune_batches, nodes=numa_nodes, log=log)
+        runtime.configure_cpus(cpu_plan)
+        log.info(f'autotune picked {num_workers} workers, {len(cpu_plan.compute_cpus)} compute threads')
+        kwargs = runtime.loader_kwargs(num_workers, cpu_plan, k_prefetch_factor)
+        if k_sampler == "uniform":
+            train_loader = DataLoader(train_loader.dataset, batch_size=k_batch_size, shuffle=True, **kwargs)
+        else:
+            train_loader = DataLoader(train_loader.dataset, batch_size=k_batch_size, sampler=train_sampler, **kwargs)
+        dev_loader = DataLoader(dev_loader.dataset, batch_size=k_batch_size, shuffle=False, **kwargs)
+
+    def teacher_batch_logits(teacher_model, batch):
+        _, logits = forward(teacher_model, device, batch)
+        return logits
+
+    teacher, teacher_cache = None, None
+    if k_teacher_model is not None:
+        teacher = util.load_pretrained(T5ForConditionalGeneration, k_teacher_model, k_weights_dir)
+        teacher.to(device)
+        teacher.eval()
+
+        dev_batch = next(iter(dev_loader))
+        teacher_latency = util.measure_latency(teacher, dev_batch["source_ids"].to(dtype=torch.long),
+                                               dev_batch["source_mask"].to(dtype=torch.long),
+                                               k_latency_examples, device=k_latency_device)
+        log.info(f'Teacher {k_teacher_model} latency: {teacher_latency:.1f} ms/example '
+                 f'on {k_latency_device} with {torch.get_num_threads()} threads')
+
+        if k_distill_cache_dir is not None:
+            assert k_distill_topk > 0, "Precomputed teacher logits need k_distill_topk > 0"
+            teacher_cache = distill.TeacherLogitCache(k_distill_cache_dir, k_teacher_model, k_data_dir, num_train,
+                                                      k_max_src_len, k_max_tgt_len, k_distill_topk)
+            if not teacher_cache.is_complete():
+                precompute_loader = DataLoader(train_loader.dataset, batch_size=k_batch_size, shuffle=False,
+                                               num_workers=num_workers)
+                teacher_cache.build(teacher, precompute_loader, teacher_batch_logits, log=log)
+            teacher_cache.open()
+            teacher = None      # no longer needed in memory
+
     log.info(f'device: {device}\n'
              f'gpu_ids: {gpu_ids}\n'
+             f'torch threads: {torch.get_num_threads()}, loader workers: {num_workers}\n'
              f'total_steps: {total_steps}\n'
              f'total_train (num_t * epoch): {total_train}\n'
              f'machine: {socket.gethostname()}\n')
@@ -283,15 +340,56 @@ def main():
 
     epoch = 0       # number of times we have passed through entire set of training examples
     step = 0        # number of total examples we have done (will be epoch * len(data_set) at end of each epoch)
+    loader_timer = runtime.LoaderTimer()    # time spent waiting on the train loader
+    metrics = MetricsBuffer(tbx, flush_every=k_log_every, resolution=k_log_resolution)
+    optim_step = 0  # number of optimizer steps
+    steps_to_target = None
+    if k_target_dev_nll is not None:
+        steps_to_target = target_report.StepsToTarget(k_target_dev_nll, k_sampler, record_dir)
     while epoch < k_epochs:
         epoch += 1
         model.train()
+        if k_freeze_encoder:
+            # keep dropout off in the frozen encoder so its outputs are deterministic (and cacheable)
+            model.get_encoder().eval()
         #tqdm用于创建进度条
-        with torch.enable_grad(), tqdm(total=num_train) as progress_bar:
-            for batch_num, batch in enumerate(train_loader):
+        if hasattr(train_sampler, "set_epoch"):
+            train_sampler.set_epoch(epoch)
+        loader_timer.reset()
+        with torch.enable_grad(), tqdm(total=len(train_sampler)) as progress_bar:
+            for batch_num, batch in enumerate(loader_timer.wrap(train_loader)):
                 batch_size = len(batch["source_ids"])
-                loss, logits = forward(model, device, batch)
-                loss_val = loss.item()      # get the item since loss is a tensor
+                if loss_tracker is not None:
+                    loss, logits, example_loss_sums = forward(model, device, batch, encoder_cache=train_cache,
+                                                              per_example=True)
+                    token_counts = batch["target_mask"].to(device).sum(dim=1)    # same tokens as the labels
+                    loss_tracker.update(batch["index"], example_loss_sums / token_counts.clamp(min=1))
+                    # importance weights undo the bias of sampling high-loss examples more often. They are applied
+                    # per token, so with equal weights this is exactly the loss from forward()
+                    weights = train_sampler.weights[batch["index"]].to(device)
+                    loss = (example_loss_sums * weights).sum() / token_counts.sum().clamp(min=1)
+                else:
+                    loss, logits = forward(model, device, batch, encoder_cache=train_cache)
+
+                if k_teacher_model is not None:
+                    if teacher_cache is not None:
+                        teacher_values, teacher_ids = teacher_cache.lookup(batch["index"], device)
+                    else:
+                        teacher_values, teacher_ids = distill.teacher_logits(teacher, teacher_batch_logits, batch,
+                                                                             k_distill_topk)
+                    target_mask = batch["target_mask"].to(device)
+                    if loss_tracker is not None:
+                        # same importance weights (per token) as the label loss above
+                        example_kl_sums = distill.distillation_loss(logits, target_mask, teacher_values, teacher_ids,
+                                                                    temperature=k_distill_temperature,
+                                                                    reduction="sum")
+                        kl_loss = (example_kl_sums * weights).sum() / token_counts.sum().clamp(min=1)
+                    else:
+                        kl_loss = distill.distillation_loss(logits, target_mask, teacher_values, teacher_ids,
+                                                            temperature=k_distill_temperature)
+                    metrics.add('train/label_loss', loss.detach(), step + batch_size)
+                    metrics.add('train/kl_loss', kl_loss.detach(), step + batch_size)
+                    loss = k_distill_alpha * kl_loss + (1 - k_distill_alpha) * loss
 
                 # Backward
                 optimizer.zero_grad()
@@ -299,22 +397,32 @@ def main():
                 nn.utils.clip_grad_norm_(model.parameters(), k_max_grad_norm)
                 optimizer.step()
                 scheduler.step()        # don't need to pass step to scheduler
+                optim_step += 1
 
                 # Log info
+                # the loss stays a tensor here; calling loss.item() every batch would sync with the device
                 step += batch_size
                 progress_bar.update(batch_size)
-                progress_bar.set_postfix(epoch=epoch,
-                                         loss=loss_val)
-                tbx.add_scalar('train/loss', loss_val, step)
-                tbx.add_scalar('train/LR',
-                               optimizer.param_groups[0]['lr'],
-                               step)
+                metrics.add('train/loss', loss.detach(), step)
+                metrics.add('train/LR', optimizer.param_groups[0]['lr'], step)
+                latest = metrics.step()
+                if latest:
+                    progress_bar.set_postfix(epoch=epoch,
+                                             loss=latest['train/loss'])
+
+        metrics.flush(partial=True)
+        log.info(f'Train loader stall: {loader_timer.stall_secs:.1f}s '
+                 f'({loader_timer.stall_fraction:.1%} of {loader_timer.total_secs:.1f}s)')
+        tbx.add_scalar('train/loader_stall_secs', loader_timer.stall_secs, step)
 
         ###############
         # Evaluate (you might want to save checkpoints)
         ###############
         log.info(f'Evaluating at step {step}...')
         model.eval()        # put model in eval mode
+        if dev_cache is not None:
+            # the encoder weights only change while training it, so a frozen encoder keeps the dev cache
+            dev_cache.set_version(k_model if k_freeze_encoder else f'{k_model}@{step}')
 
         # See how the model is doing with exact match on tokens
         pred_list_all = []                      # accumulate for saving; list; one list per epoch
@@ -324,6 +432,7 @@ def main():
         # set up two count variables
         total_matches_no_eos_ct = 0
         total_matches_with_eos_ct = 0
+        latency_ms = 0.0
 
         with torch.no_grad(), \
              tqdm(total=num_val) as progress_bar:
@@ -331,7 +440,7 @@ def main():
                 batch_size = len(batch["source_ids"])
 
                 # evaluation for loss fcn
-                loss, _ = forward(model, device, batch)     # loss, logits, but don't need logits
+                loss, _ = forward(model, device, batch, encoder_cache=dev_cache)     # loss, logits, but don't need logits
                 loss_meter.update(loss.item(), batch_size)  # loss.item() since it's a tensor
 
                 # predict / generate for token matches
@@ -339,7 +448,13 @@ def main():
                 src_mask = batch["source_mask"].to(device, dtype=torch.long)
                 tgt_ids = batch["target_ids"].to(device, dtype=torch.long)
                 # note you could tweak the generation params. See huggingface details for generate
-                generated_ids = model.generate(src_ids, attention_mask=src_mask)       # (batch x seq length)
+                if dev_cache is not None:
+                    # the encoder outputs were cached by forward() above
+                    encoder_outputs = dev_cache.encode(model, src_ids, src_mask, batch["index"])
+                    generated_ids = model.generate(src_ids, attention_mask=src_mask,
+                                                   encoder_outputs=encoder_outputs)
+                else:
+                    generated_ids = model.generate(src_ids, attention_mask=src_mask)       # (batch x seq length)
 
                 # collect some stats
                 total_matches_no_eos, total_matches_with_eos, correct_indices = \
@@ -363,6 +478,18 @@ def main():
                     for orig_input, orig_target, actual_output in preds[:1]:
                         log.info(f'Source: {orig_input}\t Target: {orig_target}\n'
                                  f'\t Actual: {actual_output}')
+                    if dev_cache is not None and k_check_encoder_cache:
+                        # results must not depend on whether the encoder outputs came from the cache
+                        ref_loss, _ = forward(model, device, batch)
+                        ref_ids = model.generate(src_ids, attention_mask=src_mask)
+                        assert torch.allclose(loss, ref_loss, rtol=1e-5, atol=1e-6), \
+                            f"Cached loss {loss.item()} != uncached loss {ref_loss.item()}"
+                        assert torch.equal(generated_ids, ref_ids), "Cached and uncached generate() outputs differ"
+                    # inference latency, one example at a time as when serving
+                    latency_ms = util.measure_latency(model, src_ids, src_mask, k_latency_examples,
+                                                      device=k_latency_device)
+                    log.info(f'Latency: {latency_ms:.1f} ms/example on {k_latency_device} '
+                             f'with {torch.get_num_threads()} threads')
 
                 # Log info
                 progress_bar.update(batch_size)
@@ -373,12 +500,19 @@ def main():
         util.save_preds(pred_list_correct, record_dir, file_name="preds_correct.csv")
         results_list = [('NLL', loss_meter.avg),
                         ('exact_match_with_eos', total_matches_with_eos_ct),
-                        ('exact_match_no_eos', total_matches_no_eos_ct)]
+                        ('exact_match_no_eos', total_matches_no_eos_ct),
+                        ('latency_ms', latency_ms)]
         results = OrderedDict(results_list)
 
         # Log to console
         results_str = ', '.join(f'{k}: {v:05.2f}' for k, v in results.items())
         log.info(f'Dev {results_str}')
+        if steps_to_target is not None and steps_to_target.update(loss_meter.avg, optim_step, step, epoch):
+            log.info(f'Dev NLL reached {k_target_dev_nll} after {optim_step} steps ({k_sampler} sampling)')
+            tbx.add_scalar('dev/steps_to_target', optim_step, step)
+        for split, cache in (("train", train_cache), ("dev", dev_cache)):
+            if cache is not None:
+                log.info(f'Encoder cache ({split}): {len(cache)} entries, {cache.hits} hits, {cache.misses} misses')
 
         # Log to TensorBoard
         for k, v in results.items():
@@ -389,10 +523,18 @@ def main():
                        split='dev',
                        num_visuals=3)
 
+        if k_save_model:
+            # e.g. to use as a teacher (k_teacher_model) for a smaller model
+            model.save_pretrained(os.path.join(record_dir, "model"))
+            tokenizer.save_pretrained(os.path.join(record_dir, "model"))
+
+    metrics.close()
+
 
 if __name__ == '__main__':
     name = kname
     if k_use_wandb:
+        import wandb
         wandb.init()
         record_dir = wandb.run.dir
         wandb.tensorboard.patch(save=True, tensorboardX=True)
@@ -400,7 +542,11 @@ if __name__ == '__main__':
         record_dir = util.get_save_dir(k_save_dir, name)
 
     log = util.get_logger(record_dir, "root", "debug")
-    tbx = SummaryWriter(record_dir, flush_secs=5)
+    if k_use_tensorboard or k_use_wandb:
+        from tensorboardX import SummaryWriter
+        tbx = SummaryWriter(record_dir, flush_secs=5)
+    else:
+        tbx = util.NullWriter()
     log.info(name)
     log.info(comment)
     main()
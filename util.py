@@ -1,14 +1,21 @@
+from __future__ import annotations
+
 import glob
+import importlib.util
 import logging
 import os
 import random
 import re
+import time
 from typing import *
 
-import numpy as np
-import torch
 import tqdm
 
+# numpy and torch are imported inside the functions that use them, so that importing this module
+# (e.g. for get_save_dir / get_logger) does not pay for them
+if TYPE_CHECKING:
+    import torch
+
 
 # todo: fix logging in this file
 
@@ -80,6 +87,8 @@ def save_preds(preds: List[Tuple[str,str,str]], save_dir, file_name='predictions
     Returns:
         save_path (str): Path where CSV file was saved.
     """
+    import numpy as np
+
     save_path = os.path.join(save_dir, file_name)
     np.savetxt(save_path, np.array(preds), delimiter='|', fmt='%s',encoding='utf-8')
 
@@ -104,6 +113,8 @@ def masked_token_match(tgt_ids: torch.tensor, outputs: torch.tensor,
         - optional (if return_indices): the indices where we have a match on everything up to the EOS token
 
     """
+    import torch
+
     # left-shift
     # assert (output_ids[:,0] == 0)       # T5 should start with a pad token; other models could vary
     output_shifted = outputs[:,1:]
@@ -131,6 +142,31 @@ def masked_token_match(tgt_ids: torch.tensor, outputs: torch.tensor,
         return total_matches_no_eos, total_matches_with_eos
 
 
+def per_example_loss(logits: torch.Tensor, labels: torch.Tensor, reduction="mean") -> torch.Tensor:
+    """Token cross entropy of every example in a batch.
+
+    Args:
+        logits (torch.Tensor): (batch_size, seq_len, vocab_size) model outputs.
+        labels (torch.Tensor): (batch_size, seq_len) target ids, with -100 where the loss is ignored.
+        reduction (str): "mean" over each example's tokens, or "sum" (summing these and dividing by the
+            batch's token count gives the model's own loss).
+
+    Returns:
+        losses (torch.Tensor): (batch_size,) tensor on the same device as `logits`.
+    """
+    import torch
+
+    token_loss = torch.nn.functional.cross_entropy(logits.transpose(1, 2), labels,
+                                                   ignore_index=-100, reduction="none")
+    mask = (labels != -100).to(token_loss.dtype)
+    if reduction == "sum":
+        return (token_loss * mask).sum(dim=1)
+    elif reduction == "mean":
+        return (token_loss * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+    else:
+        raise ValueError(f"Invalid reduction {reduction}")
+
+
 # We use this for evaluation
 class AverageMeter:
     """Keep track of average values over time.
@@ -159,7 +195,47 @@ class AverageMeter:
         self.sum += val * num_samples
         self.avg = self.sum / self.count
 
+def measure_latency(model, src_ids: torch.Tensor, src_mask: torch.Tensor, num_examples=8, device="cpu",
+                    **generate_kwargs):
+    """Mean time to `generate` for a single example, as when serving one request at a time.
+
+    Args:
+        model: Model in eval mode.
+        src_ids (torch.Tensor): (batch_size, seq_len) source ids.
+        src_mask (torch.Tensor): (batch_size, seq_len) attention mask; padding is trimmed before generating.
+        num_examples (int): Number of examples from the batch to time.
+        device: Device to time on (we serve on the CPU). If the model is elsewhere (e.g. training on a GPU),
+            a copy of it is built on `device` for the measurement.
+
+    Returns:
+        latency_ms (float): Mean milliseconds per example.
+    """
+    import torch
+
+    device = torch.device(device)
+    if next(model.parameters()).device != device:
+        # build the copy on `device` directly rather than deep-copying on the training device
+        copy_on_device = type(model)(model.config)
+        copy_on_device.load_state_dict({k: v.to(device) for k, v in model.state_dict().items()})
+        model = copy_on_device.to(device).eval()
+    src_ids, src_mask = src_ids.to(device), src_mask.to(device)
+
+    times = []
+    with torch.no_grad():
+        for i in range(min(num_examples, len(src_ids))):
+            length = int(src_mask[i].sum())
+            start = time.perf_counter()
+            model.generate(src_ids[i:i+1, :length], attention_mask=src_mask[i:i+1, :length], **generate_kwargs)
+            if src_ids.is_cuda:
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - start)
+    return 1000 * sum(times) / max(len(times), 1)
+
+
 def set_seed(seed=42):
+    import numpy as np
+    import torch
+
     random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
@@ -174,6 +250,8 @@ def get_available_devices():
         device (torch.device): Main device (GPU 0 or CPU).
         gpu_ids (list): List of IDs of all GPUs that are available.
     """
+    import torch
+
     gpu_ids = []
     if torch.cuda.is_available():
         gpu_ids += [gpu_id for gpu_id in range(torch.cuda.device_count())]
@@ -184,6 +262,50 @@ def get_available_devices():
 
     return device, gpu_ids
 
+def load_pretrained(model_cls, name, weights_dir=None):
+    """Load a pretrained model, keeping a local safetensors copy of the weights.
+
+    The first call downloads `name` as usual and saves it to `weights_dir`. Later calls load the
+    safetensors file, which is memory-mapped rather than read into a buffer and copied again.
+    If accelerate is installed the model is also built without initializing weights that are
+    about to be overwritten.
+
+    Args:
+        model_cls: Class with `from_pretrained`, e.g. `T5ForConditionalGeneration`.
+        name (str): Model name (e.g. "t5-small") or path to a checkpoint.
+        weights_dir (str): Directory for the local copies; None loads `name` directly.
+
+    Returns:
+        model: The loaded model.
+    """
+    kwargs = {}
+    if importlib.util.find_spec("accelerate") is not None:
+        kwargs["low_cpu_mem_usage"] = True
+
+    if weights_dir is None or os.path.isdir(name):
+        return model_cls.from_pretrained(name, **kwargs)
+
+    local_dir = os.path.join(weights_dir, name.replace("/", "--"))
+    if os.path.exists(os.path.join(local_dir, "model.safetensors")):
+        return model_cls.from_pretrained(local_dir, **kwargs)
+
+    model = model_cls.from_pretrained(name, **kwargs)
+    model.save_pretrained(local_dir, safe_serialization=True)
+    return model
+
+
+class NullWriter:
+    """Stands in for `tensorboardX.SummaryWriter` when TensorBoard logging is off."""
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+    def add_text(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
 def get_logger(log_dir, name, log_level="debug"):
     """Get a `logging.Logger` instance that prints to the console
     and an auxiliary file.